@@ -6,34 +6,145 @@ import torch
 from torch import nn
 
 import struct
-from os import path
+from functools import lru_cache
+from os import path, remove, replace
 
 # Layer type identifiers (used to differentiate layer types during serialization)
 LINEAR_LAYER_TYPE = 0
 RELU_LAYER = 1
 
+# Precompiled little endian scalar packers
+FLOAT32_STRUCT = struct.Struct("<f")
+INT32_STRUCT = struct.Struct("<i")
+INT32_PAIR_STRUCT = struct.Struct("<ii")
+
+# Number of float32 values written per line of the C array
+VALUES_PER_LINE = 4
+
 # ------------------------------------------------------------------------------
-# @brief Converts a float32 value to a list of 4 bytes in little-endian format.
+# @brief Converts a float32 value to 4 bytes in little-endian format.
 # @param val Float value to convert.
-# @return List of 4 bytes representing the float.
+# @return Bytes object of length 4 representing the float.
 # ------------------------------------------------------------------------------
 def float32_to_bytes(val):
-    return list(struct.pack("<f", val))  # Little endian float32
+    return FLOAT32_STRUCT.pack(val)  # Little endian float32
 
 # ------------------------------------------------------------------------------
-# @brief Converts an int32 value to a list of 4 bytes in little-endian format.
+# @brief Views an array of float32 values as raw bytes in little-endian format.
+# @param values Array-like of floats to convert.
+# @return uint8 array holding 4 bytes per float, in flattened order.
+# ------------------------------------------------------------------------------
+def float32_array_to_byte_view(values):
+    # Only copies when the input is not already contiguous little endian float32
+    return np.ascontiguousarray(values, dtype="<f4").reshape(-1).view(np.uint8)
+
+# ------------------------------------------------------------------------------
+# @brief Converts an int32 value to 4 bytes in little-endian format.
 # @param val Integer value to convert.
-# @return List of 4 bytes representing the integer.
+# @return Bytes object of length 4 representing the integer.
 # ------------------------------------------------------------------------------
 def int32_to_bytes(val):
-    return list(struct.pack("<i", val))  # Little endian int32
+    return INT32_STRUCT.pack(val)  # Little endian int32
+
+# ------------------------------------------------------------------------------
+# @brief Looks up the two ASCII hex digits of every byte in a buffer.
+# @param raw Contiguous buffer (bytes or uint8 array) to convert.
+# @return uint8 array of shape (len(raw), 2) holding the high and low digits.
+# ------------------------------------------------------------------------------
+def bytes_to_hex_digits(raw):
+    # hex formats every byte in C, upper case matches the 0xAB style
+    hex_str = memoryview(raw).hex().upper()
+    return np.frombuffer(hex_str.encode("ascii"), dtype=np.uint8).reshape(-1, 2)
+
+# ------------------------------------------------------------------------------
+# @brief Returns the fixed characters of a line of C hex literals.
+# @param width Number of bytes on the line.
+# @return Read-only uint8 array of ASCII codes with placeholders for the digits.
+# ------------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def hex_line_template(width):
+    line = "    " + ", ".join(["0x00"] * width) + ",\n"
+    return np.frombuffer(line.encode("ascii"), dtype=np.uint8)
+
+# ------------------------------------------------------------------------------
+# @brief Lays out hex digit pairs as lines of C hex literals.
+# @param digits Hex digit pairs as returned by bytes_to_hex_digits.
+# @param bytes_per_line Number of bytes written per line.
+# @return Generator of strings of lines like "    0xAA, 0xBB, ...,\n" covering every byte.
+# ------------------------------------------------------------------------------
+def hex_digits_to_lines(digits, bytes_per_line):
+    full = len(digits) - len(digits) % bytes_per_line
+
+    # Full lines and the shorter last line are yielded as separate blocks
+    for block, width in ((digits[:full], bytes_per_line), (digits[full:], len(digits) - full)):
+        if len(block) == 0:
+            continue
+
+        # Each line is 4 spaces of indent followed by 6 characters per byte
+        rows = block.reshape(-1, width, 2)
+        out = np.empty((rows.shape[0], 4 + 6 * width), dtype=np.uint8)
+        out[:] = hex_line_template(width)
+
+        # Only the digits differ between lines, everything else comes from the template
+        tokens = out[:, 4:].reshape(rows.shape[0], width, 6)
+        tokens[..., 2:4] = rows
+
+        yield out.tobytes().decode("ascii")
+
+# ------------------------------------------------------------------------------
+# @brief Formats the commented sections of one layer from a single buffer.
+# @param sections Sequence of (comment, raw bytes) pairs in serialization order.
+# @param bytes_per_line Number of bytes written per line.
+# @return Generator of strings, each comment followed by its hex lines.
+# ------------------------------------------------------------------------------
+def iter_hex_sections(sections, bytes_per_line):
+    # Lay the whole layer out contiguously and look up its digits at once
+    payload = np.concatenate([np.frombuffer(raw, dtype=np.uint8) for _, raw in sections])
+    digits = bytes_to_hex_digits(payload)
+
+    # Split the digits back into the commented sections
+    offset = 0
+    for comment, raw in sections:
+        yield comment
+        yield from hex_digits_to_lines(digits[offset:offset + len(raw)], bytes_per_line)
+        offset += len(raw)
 
 # ------------------------------------------------------------------------------
 # @brief Returns the maximum workspace arena size.
 # @param seqential_model Torch Sequential model.
+# @param input_shape Shape of the model input.
+# @param forward_pass Run the model on a random input instead of walking shapes.
 # @return Integer representing the maximum number of floats needed in workspace.
 # ------------------------------------------------------------------------------
-def get_max_workspace_arena(seqential_model, input_shpae):
+def get_max_workspace_arena(seqential_model, input_shape, forward_pass=False):
+    # Only linear and ReLU layers can be sized without running the model
+    if forward_pass or not all(isinstance(layer, (nn.Linear, nn.ReLU)) for layer in seqential_model):
+        return get_max_workspace_arena_by_forward_pass(seqential_model, input_shape)
+
+    max_output = 0
+
+    # Leading dimensions are carried through unchanged, only the features change
+    batch_size = int(np.prod(input_shape[:-1]))
+    features = input_shape[-1]
+
+    for i, layer in enumerate(seqential_model):
+        if isinstance(layer, nn.Linear):
+            # Reject the same shape mismatches a forward pass would
+            if layer.in_features != features:
+                raise ValueError(
+                    f"Layer {i} ({layer}) expects {layer.in_features} input features but receives {features}"
+                )
+            features = layer.out_features
+        max_output = max(max_output, batch_size * features)  # Track max number of elements
+    return max_output
+
+# ------------------------------------------------------------------------------
+# @brief Returns the maximum workspace arena size by running a forward pass.
+# @param seqential_model Torch Sequential model.
+# @param input_shape Shape of the model input.
+# @return Integer representing the maximum number of floats needed in workspace.
+# ------------------------------------------------------------------------------
+def get_max_workspace_arena_by_forward_pass(seqential_model, input_shape):
     max_output = 0
 
     # Create random input tensor based on model's expected input shape
@@ -45,27 +156,34 @@ def get_max_workspace_arena(seqential_model, input_shpae):
     return max_output
 
 # ------------------------------------------------------------------------------
-# @brief Converts a PyTorch Sequential model into a C header file.
+# @brief Generates the C header for a PyTorch Sequential model chunk by chunk.
 # @param seqential_model PyTorch model object.
-# @param model_name Name used for C array and header file.
-# @param dir Directory to write the header file into.
+# @param model_name Name used for C array and header guard.
+# @param input_shape Shape of the model input.
+# @return Generator of strings which together form the header file.
 # ------------------------------------------------------------------------------
-def convert_sequential_model_to_c(seqential_model, model_name, input_shape, dir="."):
-    # Start building the C array
-    c_array = f"#ifndef {model_name.upper()}_H\n#define {model_name.upper()}_H\n\n"
-    
+def iter_sequential_model_to_c(seqential_model, model_name, input_shape):
+    # Names used by the header guard and the C array
+    guard_name = f"{model_name.upper()}_H"
+    array_name = model_name.lower()
+
+    # Start the C array
+    yield f"#ifndef {guard_name}\n#define {guard_name}\n\n"
+
     # Add number of layers as a preprocessor define
-    c_array += "// Number of Layers\n"
-    c_array += f"#define NO_LAYERS     {len(seqential_model)}\n\n"
+    yield "// Number of Layers\n"
+    yield f"#define NO_LAYERS     {len(seqential_model)}\n\n"
 
     # Add worksheet arena size as a preprocessor define
-    c_array += "// Max worksheet arena\n"
-    c_array += f"#define WORKSHEET_ARENA_SIZE     {get_max_workspace_arena(seqential_model, input_shape)}\n\n"
+    yield "// Max worksheet arena\n"
+    yield f"#define WORKSHEET_ARENA_SIZE     {get_max_workspace_arena(seqential_model, input_shape)}\n\n"
 
-    c_array += f"unsigned char {model_name.lower()}[] = {{\n"
+    yield f"unsigned char {array_name}[] = {{\n"
 
     # Serialize each layer
-    for i, layer in enumerate(seqential_model):
+    step = 4 * VALUES_PER_LINE
+    prev_output_size = input_shape[-1]  # A leading ReLU sees the model input features
+    for layer in seqential_model:
         if isinstance(layer, nn.Linear):
             # Extract weights and biases
             weight = layer.weight.cpu().detach().numpy()
@@ -73,61 +191,51 @@ def convert_sequential_model_to_c(seqential_model, model_name, input_shape, dir=
 
             output_size, input_size = weight.shape
             model_type = LINEAR_LAYER_TYPE
+            prev_output_size = output_size
 
-            # Serialize linear layer metadata
-            c_array += "\n    // Layer Type: Linear Layer\n"
-            c_array += "    " + ", ".join([f"0x{b:02X}" for b in int32_to_bytes(model_type)]) + ",\n"
-
-            c_array += "    // Output size and Input size\n"
-            c_array += "    " + ", ".join([f"0x{b:02X}" for b in (
-                int32_to_bytes(output_size) + int32_to_bytes(input_size)
-            )]) + ",\n"
-
-            # Serialize weights
-            section = max(len(weight.flatten()) // 4, 1)
-            c_array += "    // Weight\n"
-            for line in np.array_split(weight.flatten(), section):
-                c_array += "    " + ", ".join(
-                    [f"0x{b:02X}" for val in line for b in float32_to_bytes(val)]
-                ) + ",\n"
-
-            # Serialize biases
-            section = max(len(bias.flatten()) // 4, 1)
-            c_array += "    // Bias\n"
-            for line in np.array_split(bias.flatten(), section):
-                c_array += "    " + ", ".join(
-                    [f"0x{b:02X}" for val in line for b in float32_to_bytes(val)]
-                ) + ",\n"
+            # Serialize linear layer metadata, weights and biases
+            yield from iter_hex_sections((
+                ("\n    // Layer Type: Linear Layer\n", int32_to_bytes(model_type)),
+                ("    // Output size and Input size\n", INT32_PAIR_STRUCT.pack(output_size, input_size)),
+                ("    // Weight\n", float32_array_to_byte_view(weight)),
+                ("    // Bias\n", float32_array_to_byte_view(bias)),
+            ), step)
 
         elif isinstance(layer, nn.ReLU):
-            # Get input shape from previous layer's output
+            # Input is the flat output of the previous linear layer (or the model input)
             model_type = RELU_LAYER
-            input_shape = seqential_model[i-1].bias.cpu().detach().numpy().shape
-            input_dim = len(input_shape)
-            
-            input_size = 1
-            for dim in range(input_dim):
-                input_size *= input_shape[dim]
+            input_dim = 1
+            input_size = prev_output_size
 
             # Serialize ReLU layer metadata
-            c_array += "\n    // Layer Type: ReLU Activation\n"
-            c_array += "    " + ", ".join(
-                [f"0x{b:02X}" for b in int32_to_bytes(model_type)]
-            ) + ",\n"
-
-            c_array += "    // Input dimensions and shape\n"
-            c_array += "    " + ", ".join(
-                [f"0x{b:02X}" for b in (
-                    int32_to_bytes(input_dim) + int32_to_bytes(input_size)
-                )]
-            ) + ",\n"
+            yield from iter_hex_sections((
+                ("\n    // Layer Type: ReLU Activation\n", int32_to_bytes(model_type)),
+                ("    // Input dimensions and shape\n", INT32_PAIR_STRUCT.pack(input_dim, input_size)),
+            ), step)
 
     # Finalize the header file
-    c_array += f"}};\n\nunsigned int {model_name.lower()}_len = sizeof({model_name.lower()});\n\n#endif // {model_name.upper()}_H\n"
+    yield f"}};\n\nunsigned int {array_name}_len = sizeof({array_name});\n\n#endif // {guard_name}\n"
+
+# ------------------------------------------------------------------------------
+# @brief Converts a PyTorch Sequential model into a C header file.
+# @param seqential_model PyTorch model object.
+# @param model_name Name used for C array and header file.
+# @param input_shape Shape of the model input.
+# @param dir Directory to write the header file into.
+# ------------------------------------------------------------------------------
+def convert_sequential_model_to_c(seqential_model, model_name, input_shape, dir="."):
+    header_path = path.join(dir, f"{model_name}.h")
+    tmp_path = header_path + ".tmp"
 
-    # Write to file
-    with open(path.join(dir, f"{model_name}.h"), "w") as file:
-        file.write(c_array)
+    # Stream each chunk to a temporary file so a failed conversion leaves any existing header untouched
+    try:
+        with open(tmp_path, "w") as file:
+            file.writelines(iter_sequential_model_to_c(seqential_model, model_name, input_shape))
+        replace(tmp_path, header_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            remove(tmp_path)
+        raise
 
 # ------------------------------------------------------------------------------
 # @brief Entry point when the script is run as a standalone module.